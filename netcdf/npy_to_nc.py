@@ -2,6 +2,7 @@ import numpy as np
 import os
 import sys
 
+import h5py
 import netCDF4 as nc4
 
 from src.track_alignment import map_and_reduce
@@ -30,7 +31,18 @@ channel_params = { # offset, scale_factor, min_value, max_value
     'surface_temperature' : [-15000, 0.00999999977648258, 0, 20000], 
 }
 
-def copy_dataset_structure(original_filename, copy_filename, deep=True, zlib=True):
+def get_chunksizes(dimensions, chunk):
+    """ returns the chunk shape of a variable of given dimensions: <chunk> on its leading dimensions, capped to their length, and their full length on the remaining ones. None if the variable has less dimensions than <chunk> """
+
+    if chunk is None or len(dimensions) < len(chunk):
+        return None
+
+    chunksizes = [size if dim.isunlimited() else min(size, len(dim)) for dim, size in zip(dimensions, chunk)]
+    chunksizes += [len(dim) for dim in dimensions[len(chunk):]]
+
+    return tuple(chunksizes)
+
+def copy_dataset_structure(original_filename, copy_filename, deep=True, zlib=True, chunk=None, complevel=4, shuffle=True):
     
     with nc4.Dataset(original_filename, 'r') as original:
 
@@ -57,7 +69,8 @@ def copy_dataset_structure(original_filename, copy_filename, deep=True, zlib=Tru
             # Copy variables
             for name, var in block.variables.items():
 
-                new_var = new_block.createVariable(name, var.datatype, var.dimensions, zlib=zlib)
+                chunksizes = get_chunksizes([new_block.dimensions[dim] for dim in var.dimensions], chunk)
+                new_var = new_block.createVariable(name, var.datatype, var.dimensions, zlib=zlib, complevel=complevel, shuffle=shuffle, chunksizes=chunksizes)
                 
                 # Copy variable attributes
                 new_var.setncatts({a : var.getncattr(a) for a in var.ncattrs()})
@@ -66,12 +79,19 @@ def copy_dataset_structure(original_filename, copy_filename, deep=True, zlib=Tru
 
     return copy, variables
 
-def fill_dataset(dataset, variables, swath, layer_info, minutes, status="daylight", deep=True):
+def fill_dataset(dataset, variables, swath, layer_info, minutes, status="daylight", deep=True, latlon=None):
 
     shape = swath[0].shape
 
+    # if provided, latitudes and longitudes are taken at full precision rather than from the swath
+    geolocation = {} if latlon is None else {"latitude": latlon[0], "longitude": latlon[1]}
+
     for i, channel in enumerate(swath_channels):
 
+        if channel in geolocation:
+            variables[channel][0] = geolocation[channel].T
+            continue
+
         try:
 
             invalid_mask = (swath[i] < channel_params[channel][2]) | (swath[i] > channel_params[channel][3])
@@ -123,7 +143,16 @@ def load_npys(swath_path, layer_info_dir="layer-info"):
 
     dirname, filename = os.path.split(swath_path)
 
-    swath = np.load(swath_path)
+    if filename.endswith(".h5"):
+
+        with h5py.File(swath_path, "r") as f:
+            swath = f["data"][...]
+
+        # layer information is still saved as npy
+        filename = filename.replace(".h5", ".npy")
+
+    else:
+        swath = np.load(swath_path)
 
     try:
         layer_info_dict = np.load(os.path.join(dirname, layer_info_dir, filename)).item()
@@ -133,9 +162,11 @@ def load_npys(swath_path, layer_info_dir="layer-info"):
 
     return swath, layer_info_dict
 
-def save_as_nc(swath, layer_info, swath_path, save_name):
+def save_as_nc(swath, layer_info, swath_path, save_name, latlon=None, chunk=(1, 256, 256), complevel=4):
+    """ swath variables are compressed with shuffle + zlib at <complevel> and chunked by <chunk> over their (time, x, y) dimensions, so that spatial subsets are read from few chunks.
+    The chunks are not aligned to the tile size of extract_tiles_from_swath: tiles are cut from the in-memory swath, not read back from the netcdf file """
 
-    copy, variables = copy_dataset_structure(os.path.join("netcdf", "cumulo.nc"), save_name)
+    copy, variables = copy_dataset_structure(os.path.join("netcdf", "cumulo.nc"), save_name, chunk=chunk, complevel=complevel)
 
     # determine swath status from directory hierarchy
     status = "corrupt"
@@ -147,7 +178,7 @@ def save_as_nc(swath, layer_info, swath_path, save_name):
     # convert npy to nc
     year, abs_day, hour, minute = get_file_time_info(swath_path)
     minutes_since_2008 = minutes_since(int(year), int(abs_day), int(hour), int(minute))
-    fill_dataset(copy, variables, swath, layer_info, minutes_since_2008, status)
+    fill_dataset(copy, variables, swath, layer_info, minutes_since_2008, status, latlon=latlon)
 
     copy.close()
 
@@ -175,7 +206,7 @@ if __name__ == "__main__":
 
     #create a copy of reference dataset
     copy_name = "A{}.{}.{}{}.nc".format(year, abs_day, hour, minute)
-    copy, variables = copy_dataset_structure(os.path.join("netcdf", "cumulo.nc"), os.path.join(save_dir, month, status, copy_name))
+    copy, variables = copy_dataset_structure(os.path.join("netcdf", "cumulo.nc"), os.path.join(save_dir, month, status, copy_name), chunk=(1, 256, 256))
 
     # convert npy to nc
     minutes_since_2008 = minutes_since(int(year), int(abs_day), int(hour), int(minute))
@@ -1,16 +1,19 @@
+import logging
 import numpy as np
 import os
 import time
 
-from PIL import Image
+# the readers and writers (satpy, pyhdf, numba, h5py, netCDF4, PIL) are imported by the functions using them,
+# so that workers skipping already extracted swaths do not pay for loading them
 
-import src.cloudsat
-import src.interpolation
-import src.modis_level1
-import src.modis_level2
-import src.tile_extraction
+# arrays reused from one swath to the next by process_swath, not to reallocate them in long batch runs
+_swath_buffers = {}
 
-def extract_full_swath(myd02_filename, myd03_dir, myd06_dir, myd35_dir, cloudsat_lidar_dir, cloudsat_dir, save_dir, verbose=1, save=True):
+# indices of the MODIS level 1 channels that are full after interpolation, for daylight and night swaths
+DAYLIGHT_CHANNELS = tuple(range(15))
+NIGHT_CHANNELS = tuple(range(2, 7)) + tuple(range(8, 15))
+
+def extract_full_swath(myd02_filename, myd03_dir, myd06_dir, myd35_dir, cloudsat_lidar_dir, cloudsat_dir, save_dir, verbose=1, save=True, buffers=None, fmt="h5"):
     """
     :param myd02_filename: the filepath of the radiance (MYD02) input file
     :param myd03_dir: the root directory of geolocational (MYD03) files
@@ -20,10 +23,23 @@ def extract_full_swath(myd02_filename, myd03_dir, myd06_dir, myd35_dir, cloudsat
     :param cloudsat_dir: the root directory of cloudsat files
     :param save_dir:
     :param verbose: verbosity switch: 0 - silent, 1 - verbose, 2 - partial, only prints confirmation at end
+    :param fmt: format of the saved swath, "h5" for a chunked and compressed hdf5 or "npy" for the former npy output
+    :param buffers: optional dictionary of arrays reused across calls, filled on the first call. The returned swath is then one of these arrays and is overwritten by the next call
     :return: none
     Expects to find a corresponding MYD03 file in the same directory. Comments throughout
     """
 
+    import src.cloudsat
+    import src.interpolation
+    import src.modis_level1
+    import src.modis_level2
+
+    if fmt not in ("h5", "npy"):
+        raise ValueError("unknown swath format {}, expected h5 or npy".format(fmt))
+
+    if buffers is None:
+        buffers = {}
+
     tail = os.path.basename(myd02_filename)
 
     # creating the save directories
@@ -31,12 +47,25 @@ def extract_full_swath(myd02_filename, myd03_dir, myd06_dir, myd35_dir, cloudsat
     save_dir_night = os.path.join(save_dir, "night")
     save_dir_corrupt = os.path.join(save_dir, "corrupt")
 
+    # exist_ok, as concurrent workers may create them at the same time
     for dr in [save_dir_daylight, save_dir_night, save_dir_corrupt]:
-        if not os.path.exists(dr):
-            os.makedirs(dr)
+        os.makedirs(dr, exist_ok=True)
 
     # pull a numpy array from the hdfs
-    np_swath = src.modis_level1.get_swath(myd02_filename, myd03_dir)
+    l1_swath = buffers["l1"] = src.modis_level1.get_swath(myd02_filename, myd03_dir, out=buffers.get("l1"))
+
+    # the output stacks level 1, level 2 and cloud mask channels as float16, each source is cast while being copied into its slice
+    nb_rad, nb_l1, nb_l2 = l1_swath.shape[0] - 2, l1_swath.shape[0], len(src.modis_level2.L2_CHANNELS)
+    swath_shape = (nb_l1 + nb_l2 + 1, *l1_swath.shape[1:])
+
+    np_swath = buffers.get("swath")
+
+    if np_swath is None or np_swath.shape != swath_shape:
+        np_swath = buffers["swath"] = np.empty(swath_shape, dtype=np.float16)
+
+    # radiances are processed as float16 from here on, latitudes and longitudes are kept as float32 for the cloudsat alignment
+    np.copyto(np_swath[:nb_rad], l1_swath[:nb_rad], casting='unsafe')
+    latlon = l1_swath[nb_rad:]
 
     if verbose:
         print("swath {} loaded".format(tail))
@@ -44,7 +73,8 @@ def extract_full_swath(myd02_filename, myd03_dir, myd06_dir, myd35_dir, cloudsat
     # as some bands have artefacts, we need to interpolate the missing data - time intensive
     t1 = time.time()
     
-    filled_ch_idx = src.interpolation.fill_all_channels(np_swath)  
+    filled_ch_idx = src.interpolation.fill_all_channels(np_swath[:nb_rad])
+    filled_ch_idx += [nb_rad + i for i in src.interpolation.fill_all_channels(latlon)]
     
     t2 = time.time()
 
@@ -52,35 +82,47 @@ def extract_full_swath(myd02_filename, myd03_dir, myd06_dir, myd35_dir, cloudsat
         print("Interpolation took {} s".format(t2-t1))
         print("Channels", filled_ch_idx, "are now full")
 
-    # if all channels were filled
-    if len(filled_ch_idx) == 15:
-        save_subdir = save_dir_daylight
+    # daylight if all channels were filled, night if all but visible channels were filled
+    save_subdir = {
+        DAYLIGHT_CHANNELS: save_dir_daylight,
+        NIGHT_CHANNELS: save_dir_night,
+    }.get(tuple(filled_ch_idx), save_dir_corrupt)
 
-    # if all but visible channels were filled
-    elif filled_ch_idx == list(range(2, 7)) + list(range(8, 15)):
-        save_subdir = save_dir_night
+    # level 2 and cloud mask files are located and opened once
+    l2_data, cm_data = src.modis_level2.open_l2_and_l35(myd02_filename, myd06_dir, myd35_dir)
 
-    else:
-        save_subdir = save_dir_corrupt
+    try:
 
-    # pull L2 channels here
-    l2_channels = src.modis_level2.get_channels(myd02_filename, myd06_dir)
-    
-    if verbose:
-        print("Level2 channels loaded")
+        # pull L2 channels here, directly into the output
+        l2_out = np_swath[nb_l1:nb_l1 + nb_l2]
+        l2_channels = src.modis_level2.get_channels(l2_data, out=l2_out)
 
-    # pull cloud mask channel
-    cm = src.modis_level2.get_cloud_mask(myd02_filename, myd35_dir)
+        # get_channels only allocates a new array when the level 2 shape differs from the level 1 one
+        if l2_channels is not l2_out:
+            raise ValueError("level 2 channels of shape {} do not match the level 1 swath of shape {}".format(l2_channels.shape, l1_swath.shape))
 
-    if verbose:
-        print("Cloud mask loaded")
+        if verbose:
+            print("Level2 channels loaded")
+
+        # pull cloud mask channel
+        cm = src.modis_level2.get_cloud_mask(cm_data)
+
+        if verbose:
+            print("Cloud mask loaded")
+
+    finally:
+
+        l2_data.end()
+        cm_data.end()
 
     # get cloudsat alignment - time intensive
     t1 = time.time()
 
+    cs_range, mapping, layer_info = None, None, None
+
     try:
 
-        cs_range, mapping, layer_info = src.cloudsat.get_cloudsat_mask(myd02_filename, cloudsat_lidar_dir, cloudsat_dir, np_swath[-2], np_swath[-1], map_labels=False)
+        cs_range, mapping, layer_info = src.cloudsat.get_cloudsat_mask(myd02_filename, cloudsat_lidar_dir, cloudsat_dir, latlon[0], latlon[1], map_labels=False)
 
     except Exception as e:
 
@@ -91,70 +133,96 @@ def extract_full_swath(myd02_filename, myd03_dir, myd06_dir, myd35_dir, cloudsat
     if verbose:
         print("Cloudsat alignment took {} s".format(t2 - t1))
 
-    # cast swath values to float
-    np_swath = np.vstack([np_swath, l2_channels, cm[None, ]]).astype(np.float16)
+    # complete the output with the geolocation and the cloud mask
+    np.copyto(np_swath[nb_rad:nb_l1], latlon, casting='unsafe')
+    np.copyto(np_swath[-1], cm, casting='unsafe')
 
-    # create the save path for the swath array, and save the array as a npy, with the same name as the input file.
-    swath_savepath_str = os.path.join(save_subdir, tail.replace(".hdf", ".npy"))
+    # create the save path for the swath array, and save the array as a hdf5 chunked by channel (or as a npy), with the same name as the input file.
+    swath_savepath_str = os.path.join(save_subdir, tail.replace(".hdf", "." + fmt))
     
     if save:
-        np.save(swath_savepath_str, np_swath, allow_pickle=False)
+
+        if fmt == "npy":
+            save_as_npy(swath_savepath_str, np_swath)
+        else:
+            save_as_h5(swath_savepath_str, chunk_length=1, data=np_swath)
 
         if verbose:
             print("swath saved as {}".format(swath_savepath_str))
     
-    try:
+    # layer_info is None if the cloudsat track could not be extracted
+    if layer_info is not None:
 
-        layer_info.update({"width-range": cs_range, "mapping": mapping})
+        layer_info["width-range"] = cs_range
+        layer_info["mapping"] = mapping
         
         if save:
 
             layer_info_savepath = os.path.join(save_subdir, "layer-info")
-    
-            if not os.path.exists(layer_info_savepath):
-                os.makedirs(layer_info_savepath)
+            os.makedirs(layer_info_savepath, exist_ok=True)
             
             np.save(os.path.join(layer_info_savepath, tail.replace(".hdf", ".npy")), layer_info)
 
-    except:
-        
-        layer_info = None
-
-    return np_swath, layer_info, save_subdir, tail
+    # the float16 swath also holds the geolocation, returned apart at its original float32 precision
+    return np_swath, layer_info, save_subdir, tail, latlon
 
 def extract_tiles_from_swath(np_swath, swath_name, save_dir, tile_size=3, stride=3, verbose=1):
+    """ returns False if no tile could be extracted from the swath, so that batch callers skip it and keep their process alive """
+
+    import src.tile_extraction
+
     # sample the swath for a selection of tiles and its associated metadata
     try: 
         label_tiles, nonlabel_tiles, label_metadata, nonlabel_metadata = src.tile_extraction.sample_labelled_and_unlabelled_tiles(np_swath, tile_size=tile_size)
 
     except ValueError as e:
-        print("Tiles failed to extract.", str(e))
-        exit(0)
+        logging.warning("tile extract failed for %s: %s", swath_name, e)
+        return False
 
     if verbose > 0:
         print("{} tiles extracted from swath {}".format(len(label_tiles) + len(nonlabel_tiles), swath_name))
 
-    label_tiles_savepath_str = os.path.join(save_dir, "label", "tiles")
-    label_metadata_savepath_str = os.path.join(save_dir, "label", "metadata")
-
-    nonlabel_tiles_savepath_str = os.path.join(save_dir, "nonlabel", "tiles")
-    nonlabel_metadata_savepath_str = os.path.join(save_dir, "nonlabel", "metadata")
-
-    # create the save filepaths for the payload and metadata, and save the npys
-    for dr in [label_tiles_savepath_str, label_metadata_savepath_str, nonlabel_tiles_savepath_str, nonlabel_metadata_savepath_str]:
-        if not os.path.exists(dr):
-            os.makedirs(dr)
+    # create the save filepath for the payload and metadata, and save them as datasets of a single hdf5
+    tiles_savepath_str = os.path.join(save_dir, "tiles")
+    os.makedirs(tiles_savepath_str, exist_ok=True)
 
-    filename_npy = swath_name.replace(".hdf", ".npy")
+    filename_h5 = swath_name.replace(".hdf", ".h5")
 
-    np.save(os.path.join(label_tiles_savepath_str, filename_npy), label_tiles, allow_pickle=False)
-    np.save(os.path.join(label_metadata_savepath_str, filename_npy), label_metadata, allow_pickle=False)
-    np.save(os.path.join(nonlabel_tiles_savepath_str, filename_npy), nonlabel_tiles, allow_pickle=False)
-    np.save(os.path.join(nonlabel_metadata_savepath_str, filename_npy), nonlabel_metadata, allow_pickle=False)
+    save_as_h5(os.path.join(tiles_savepath_str, filename_h5), label_tiles=label_tiles, label_metadata=label_metadata, nonlabel_tiles=nonlabel_tiles, nonlabel_metadata=nonlabel_metadata)
 
     # save_tiles_separately(label_tiles, swath_name, os.path.join(save_dir, "label"))
     # save_tiles_separately(nonlabel_tiles, swath_name, os.path.join(save_dir, "nonlabel"))
 
+    return True
+
+def save_as_h5(filepath, chunk_length=64, **arrays):
+    """
+    :param filepath: path of the hdf5 file to create
+    :param chunk_length: number of samples per chunk along the first axis, to be matched with the size of the reads
+    :param arrays: numpy arrays to save, each one as a dataset named after its keyword
+    Datasets are compressed with the shuffle and lzf filters shipped with h5py.
+    """
+
+    import h5py
+
+    with h5py.File(filepath, "w") as f:
+
+        for name, array in arrays.items():
+
+            chunks = (min(chunk_length, array.shape[0]), *array.shape[1:])
+            f.create_dataset(name, data=array, chunks=chunks, shuffle=True, compression="lzf")
+
+def save_as_npy(filepath, array):
+    """ saves the array as a npy, kept for the consumers of the former npy outputs. The array is copied straight into a memory map of the file rather than through np.save buffering """
+
+    from numpy.lib.format import open_memmap
+
+    npy = open_memmap(filepath, mode="w+", dtype=array.dtype, shape=array.shape)
+    npy[...] = array
+    npy.flush()
+
+    del npy
+
 def save_tiles_separately(tiles, swath_name, save_dir, tile_size=3):
 
     save_dir = os.path.join(save_dir, "all-tiles")
@@ -166,66 +234,89 @@ def save_tiles_separately(tiles, swath_name, save_dir, tile_size=3):
         
         np.save(os.path.join(save_dir, "{}-{}.npy".format(swath_name.replace(".hdf", ""), i)), tile)
 
-def extract_swath_rbg(radiance_filepath, myd03_dir, save_dir, verbose=1):
+def extract_swath_rbg(radiance_filepath, myd03_dir, save_dir, tag, verbose=1):
     """
     :param radiance_filepath: the filepath of the radiance (MYD02) input file
     :param myd03_dir: the root directory of geolocational (MYD03) files
     :param save_dir:
+    :param tag: status of the swath (daylight, night or corrupt), as determined by extract_full_swath. Only daylight swaths have visible channels to save
     :param verbose: verbosity switch: 0 - silent, 1 - verbose, 2 - partial, only prints confirmation at end
     :return: none
     Generate and save RBG channels of the given MYDIS file. Expects to find a corresponding MYD03 file in the same directory. Comments throughout
     """
 
+    if tag != "daylight":
+        return
+
+    from PIL import Image
+
+    import src.modis_level1
+
     basename = os.path.basename(radiance_filepath)
 
     # creating the save subdirectory
     save_dir = os.path.join(save_dir, "rgb")
+    os.makedirs(save_dir, exist_ok=True)
 
-    if not os.path.exists(save_dir):
-        os.makedirs(save_dir)
+    try:
+        # interpolated to remove NaN artefacts and returned as a (height, width, 3) uint8 array
+        visual_swath = src.modis_level1.get_swath_rgb(radiance_filepath, myd03_dir)
 
-    visual_swath = src.modis_level1.get_swath_rgb(radiance_filepath, myd03_dir)
-    
-    #interpolate to remove NaN artefacts
-    filled_ch_idx = src.interpolation.fill_all_channels(visual_swath)
+    except ValueError as e:
+        print("Failed to interpolate RGB channels of", basename, str(e))
+        return
 
-    if len(filled_ch_idx) == 3:
+    pil_loaded_visual_swath = Image.fromarray(visual_swath, mode="RGB")
 
-        pil_loaded_visual_swath = Image.fromarray(visual_swath.transpose(1, 2, 0).astype(np.uint8), mode="RGB")
+    # png for visualization purposes only, favour speed over size
+    save_filename = os.path.join(save_dir, basename.replace(".hdf", ".png"))
+    pil_loaded_visual_swath.save(save_filename, optimize=False, compress_level=1)
 
-        save_filename = os.path.join(save_dir, basename.replace(".hdf", ".png"))
-        pil_loaded_visual_swath.save(save_filename)
+    if verbose > 0:
+        print("RGB channels saved as {}".format(save_filename))
 
-        if verbose > 0:
-            print("RGB channels saved as {}".format(save_filename))
+def get_save_name(myd02_filename):
+    """ returns the name of the netcdf file extracted from the given MYD02 file, in the format AYYYYDDD.HHMM.nc """
 
-    else:
-        print("Failed to interpolate RGB channels of", basename)
+    from src.utils import get_file_time_info
 
-# Hook for bash
-if __name__ == "__main__":
+    year, abs_day, hour, minute = get_file_time_info(myd02_filename)
 
-    import sys
+    return "A{}.{}.{}{}.nc".format(year, abs_day, hour, minute)
+
+def process_swath(myd02_filename, save_dir, existing=None):
+    """
+    :param myd02_filename: the filepath of the radiance (MYD02) input file, stored in a <month>/<day> directory
+    :param save_dir: the root directory of the extracted netcdf files
+    :param existing: set of the netcdf filenames already extracted in save_dir. If None, save_dir is searched recursively
+    :return: "exists" if the swath was already extracted in save_dir, otherwise the status of the extracted swath (daylight, night or corrupt)
+    Extracts one swath and saves it as netcdf. Top-level function, so that it can be dispatched to worker processes.
+    """
 
     from pathlib import Path
 
-    from netcdf.npy_to_nc import save_as_nc
     from src.utils import get_file_time_info
-    
-    myd02_filename = sys.argv[2]
-    save_dir = sys.argv[1]
-    
+
     root_dir, filename = os.path.split(myd02_filename)
 
     month, day = root_dir.split("/")[-2:]
 
     # get time info
     year, abs_day, hour, minute = get_file_time_info(myd02_filename)
-    save_name = "A{}.{}.{}{}.nc".format(year, abs_day, hour, minute)
+    save_name = get_save_name(myd02_filename)
+
+    if existing is not None:
+
+        if save_name in existing:
+            return "exists"
 
     # recursvely check if file exist in save_dir
-    for _ in Path(save_dir).rglob(save_name):
-        raise FileExistsError("{} already exist. Not extracting it again.".format(save_name))
+    else:
+
+        for _ in Path(save_dir).rglob(save_name):
+            return "exists"
+
+    from netcdf.npy_to_nc import save_as_nc
 
     root_dir = "/mnt/modisaqua/{}/".format(year)
     myd03_dir = os.path.join(root_dir, "MODIS", "data", "MYD03", "collection61", year, month, day)
@@ -236,22 +327,35 @@ if __name__ == "__main__":
     cloudsat_dir = os.path.join(root_dir, "CloudSat")
 
     # extract training channels, validation channels, cloud mask, class occurences if provided
-    np_swath, layer_info, save_subdir, swath_name = extract_full_swath(myd02_filename, myd03_dir, myd06_dir, myd35_dir, cloudsat_lidar_dir, cloudsat_dir, save_dir=save_dir, verbose=0, save=False)
+    np_swath, layer_info, save_subdir, swath_name, latlon = extract_full_swath(myd02_filename, myd03_dir, myd06_dir, myd35_dir, cloudsat_lidar_dir, cloudsat_dir, save_dir=save_dir, verbose=0, save=False, buffers=_swath_buffers)
+
+    tag = os.path.basename(save_subdir)
 
     # save swath as netcdf
-    save_as_nc(np_swath, layer_info, swath_name, os.path.join(save_subdir, save_name))
+    save_as_nc(np_swath, layer_info, swath_name, os.path.join(save_subdir, save_name), latlon=latlon)
 
     # # save visible channels as png for visualization purposes
-    # extract_swath_rbg(myd02_filename, os.path.join(year, month, day), save_subdir, verbose=1)
+    # extract_swath_rbg(myd02_filename, os.path.join(year, month, day), save_subdir, tag, verbose=1)
 
-    # # extract tiles for Machine Learning purposes
+    # # extract tiles for Machine Learning purposes, failures only skip the tiles of this swath
     # if np_swath.shape != (33, 2030, 1354):
-    #     print("Failed to extract tiles: tiles are extracted only from swaths with label mask", np_swath.shape)
-    #     exit(0)
+    #     logging.warning("Failed to extract tiles: tiles are extracted only from swaths with label mask %s", np_swath.shape)
+
+    # elif "corrupt" in save_subdir:
+    #     logging.warning("Failed to extract tiles: tiles are extracted only from swaths with fully interpolated non-visible channels")
+
+    # elif not extract_tiles_from_swath(np_swath, swath_name, save_subdir):
+    #     logging.warning("Swath %s saved without tiles", swath_name)
+
+    return tag
+
+# Hook for bash
+if __name__ == "__main__":
 
-    # if "corrupt" in save_subdir:
-    #     print("Failed to extract tiles: tiles are extracted only from swaths with fully interpolated non-visible channels")
-    #     exit(0)
+    import sys
 
-    # extract_tiles_from_swath(np_swath, swath_name, save_subdir)
+    myd02_filename = sys.argv[2]
+    save_dir = sys.argv[1]
 
+    if process_swath(myd02_filename, save_dir) == "exists":
+        raise FileExistsError("{} already exist. Not extracting it again.".format(get_save_name(myd02_filename)))
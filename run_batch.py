@@ -0,0 +1,114 @@
+import multiprocessing
+import os
+import sys
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from pipeline import get_save_name, process_swath
+
+MANIFEST_NAME = ".manifest"
+
+def load_manifest(save_dir, rescan=False):
+    """
+    :param save_dir: the root directory of the extracted netcdf files
+    :param rescan: if True, the manifest is rebuilt even if it exists
+    :return: set of the names of the netcdf files already extracted in save_dir
+    The manifest lists one netcdf filename per line. It is built with a single walk of save_dir if missing, and written atomically.
+    """
+
+    manifest_path = os.path.join(save_dir, MANIFEST_NAME)
+
+    if os.path.exists(manifest_path) and not rescan:
+
+        with open(manifest_path) as f:
+            return set(f.read().split())
+
+    existing = {filename for _, _, filenames in os.walk(save_dir) for filename in filenames if filename.endswith(".nc")}
+
+    os.makedirs(save_dir, exist_ok=True)
+
+    tmp_path = manifest_path + ".tmp"
+
+    with open(tmp_path, "w") as f:
+        f.writelines(filename + "\n" for filename in sorted(existing))
+
+    os.replace(tmp_path, manifest_path)
+
+    return existing
+
+def add_to_manifest(save_dir, filename):
+    """ appends a single line to the manifest, small appends are atomic """
+
+    with open(os.path.join(save_dir, MANIFEST_NAME), "a") as f:
+        f.write(filename + "\n")
+
+def find_radiance_files(root_dir):
+    """ returns the sorted list of MYD02 files found recursively in root_dir """
+
+    return sorted(str(path) for path in Path(root_dir).rglob("MYD021KM*.hdf"))
+
+def run_batch(root_dir, save_dir, max_workers=None, rescan=False, verbose=1):
+    """
+    :param root_dir: the root directory of the radiance (MYD02) input files, stored in <month>/<day> subdirectories
+    :param save_dir: the root directory of the extracted netcdf files
+    :param max_workers: number of worker processes, defaults to the number of cpus
+    :param rescan: if True, the manifest of the extracted files is rebuilt by walking save_dir
+    :param verbose: verbosity switch: 0 - silent, 1 - verbose
+    :return: dictionary mapping each input file to its status, or to the exception raised while processing it
+    Extracts all swaths under root_dir, one swath per worker process at a time. Swaths listed in the manifest of save_dir are skipped: the manifest
+    is only updated by this driver, rescan after extracting files by other means.
+    """
+
+    max_workers = max_workers or os.cpu_count()
+
+    # keep the numerical libraries of each worker single-threaded, so that the swaths share the cpus. Inherited by the spawned workers
+    for var in ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS"]:
+        os.environ.setdefault(var, "1")
+
+    # cpus left to each worker for filling the channels of its swath
+    os.environ.setdefault("CUMULO_NUM_THREADS", str(max(1, os.cpu_count() // max_workers)))
+
+    myd02_filenames = find_radiance_files(root_dir)
+    existing = load_manifest(save_dir, rescan)
+
+    # already extracted swaths are skipped here, they never reach a worker
+    statuses = {myd02_filename: "exists" for myd02_filename in myd02_filenames if get_save_name(myd02_filename) in existing}
+    myd02_filenames = [myd02_filename for myd02_filename in myd02_filenames if myd02_filename not in statuses]
+
+    if verbose:
+        print("{} swaths found in {}, {} already extracted".format(len(myd02_filenames) + len(statuses), root_dir, len(statuses)))
+
+    # spawn rather than fork, so that workers do not inherit open hdf handles
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+
+        # the manifest was already checked, an empty set spares the workers their recursive search of save_dir
+        futures = {executor.submit(process_swath, myd02_filename, save_dir, frozenset()): myd02_filename for myd02_filename in myd02_filenames}
+
+        for future in as_completed(futures):
+
+            myd02_filename = futures[future]
+
+            try:
+                statuses[myd02_filename] = future.result()
+
+            except Exception as e:
+                statuses[myd02_filename] = e
+                print("Failed to extract {}: {}".format(myd02_filename, e))
+
+            else:
+                add_to_manifest(save_dir, get_save_name(myd02_filename))
+
+                if verbose:
+                    print("{} extracted as {}".format(myd02_filename, statuses[myd02_filename]))
+
+    return statuses
+
+# Hook for bash
+if __name__ == "__main__":
+
+    save_dir = sys.argv[1]
+    root_dir = sys.argv[2]
+    max_workers = int(sys.argv[3]) if len(sys.argv) > 3 else None
+
+    run_batch(root_dir, save_dir, max_workers)
@@ -1,7 +1,13 @@
 import numpy as np
+import os
 
+from concurrent.futures import ThreadPoolExecutor
+from numba import njit
 from scipy import interpolate
 
+# number of channels filled concurrently, defaults to the number of cpus. Lowered by run_batch when swaths are also processed in parallel
+NUM_THREADS = int(os.environ.get("CUMULO_NUM_THREADS", 0)) or None
+
 def all_invalid(array, tol=5e-2):
     """ Checks if 3d array contains all invalid values.
         :param tol: tollerance ratio of invalid values 
@@ -38,6 +44,28 @@ def fill_channel(masked_array, xx, yy, method="nearest"):
     return inter
 
 def fill_all_channels(swath, method="nearest"):
+    """ 
+        Inplace function: it fills all invalid valued by spatial interpolation a channel at a time
+        :param swath (numpy.array): array of size (nb_channels, height, width) 
+        :param method (string): method for the interpolation of non floating point swaths. Check scipy.interpolate.griddata for possible methods
+        :return: list of channels that have been filled or were already full
+    """
+
+    if swath.dtype not in (np.float16, np.float32, np.float64):
+        return fill_all_channels_griddata(swath, method)
+
+    full_channels = np.ones(swath.shape[0], dtype=np.bool_)
+    invalid_idx = np.flatnonzero(np.isnan(swath).reshape(swath.shape[0], -1).any(axis=1))
+
+    # the kernel releases the GIL, channels are filled in parallel threads
+    if len(invalid_idx) > 0:
+
+        with ThreadPoolExecutor(max_workers=min(len(invalid_idx), NUM_THREADS or os.cpu_count())) as executor:
+            full_channels[invalid_idx] = list(executor.map(_fill_one_channel, [swath[i] for i in invalid_idx]))
+
+    return np.flatnonzero(full_channels).tolist()
+
+def fill_all_channels_griddata(swath, method="nearest"):
     """ 
         Inplace function: it fills all invalid valued by spatial interpolation a channel at a time
         :param swath (numpy.array): array of size (nb_channels, height, width) 
@@ -73,6 +101,90 @@ def fill_all_channels(swath, method="nearest"):
 
     return full_channels
 
+# ------------------------------------------------------------------------------ NUMBA KERNELS
+
+@njit
+def _accumulate_rows_nb(channel, num, den):
+    """ For each invalid pixel, accumulates the inverse distance weighted values of the nearest valid pixels on its left and on its right. """
+
+    height, width = channel.shape
+
+    for i in range(height):
+
+        last = -1
+        for j in range(width):
+            if np.isnan(channel[i, j]):
+                if last >= 0:
+                    weight = 1. / (j - last)
+                    num[i, j] += weight * channel[i, last]
+                    den[i, j] += weight
+            else:
+                last = j
+
+        last = -1
+        for j in range(width - 1, -1, -1):
+            if np.isnan(channel[i, j]):
+                if last >= 0:
+                    weight = 1. / (last - j)
+                    num[i, j] += weight * channel[i, last]
+                    den[i, j] += weight
+            else:
+                last = j
+
+@njit(nogil=True)
+def _fill_channel_nb(channel):
+    """ 
+        Inplace function: it fills the invalid values of a 2d array with a bilinear combination of the nearest valid pixels along its row and its column
+        :return: True if the channel is now full
+    """
+
+    height, width = channel.shape
+
+    nb_invalid = 0
+    for i in range(height):
+        for j in range(width):
+            if np.isnan(channel[i, j]):
+                nb_invalid += 1
+
+    # pixels with no valid neighbour on their row nor their column are filled by the following passes
+    while nb_invalid > 0:
+
+        num = np.zeros(channel.shape, channel.dtype)
+        den = np.zeros(channel.shape, channel.dtype)
+
+        _accumulate_rows_nb(channel, num, den)
+        _accumulate_rows_nb(channel.T, num.T, den.T)
+
+        nb_filled = 0
+        for i in range(height):
+            for j in range(width):
+                if den[i, j] > 0:
+                    channel[i, j] = num[i, j] / den[i, j]
+                    nb_filled += 1
+
+        if nb_filled == 0:
+            break
+
+        nb_invalid -= nb_filled
+
+    return nb_invalid == 0
+
+def _fill_one_channel(channel):
+    """ Inplace function: it fills the invalid values of a 2d array, returns True if the channel is now full """
+
+    # numba has no half precision arithmetic, float16 channels are filled on a float32 copy
+    buffer = np.ascontiguousarray(channel, dtype=np.promote_types(channel.dtype, np.float32))
+
+    full = _fill_channel_nb(buffer)
+
+    if buffer is not channel:
+        channel[...] = buffer
+
+    return full
+
+# compile the kernel once at import rather than on the first swath
+_fill_channel_nb(np.array([[0., np.nan], [np.nan, 1.]], dtype=np.float32))
+
 if __name__ == "__main__":
 
     # kinda test all invalid
@@ -84,3 +196,30 @@ if __name__ == "__main__":
     partial_inv_array[0] = np.NaN
     assert not all_invalid(partial_inv_array)
 
+
+    # kinda test fill all channels
+
+    # a NaN inside a row is filled linearly between its neighbours, an all NaN channel is not reported as filled
+    swath = np.ones((2, 1, 5), dtype=np.float32)
+    swath[0, 0, :] = [1., 2., np.nan, np.nan, 5.]
+    swath[1] = np.nan
+
+    assert fill_all_channels(swath) == [0]
+    assert np.allclose(swath[0, 0, 2:4], [3., 4.])
+    assert np.all(np.isnan(swath[1]))
+
+    # a float16 swath is filled in place
+    swath = np.zeros((1, 3, 3), dtype=np.float16)
+    swath[0, 1, 1] = np.nan
+
+    assert fill_all_channels(swath) == [0]
+    assert swath.dtype == np.float16
+    assert not np.any(np.isnan(swath))
+    assert swath[0, 1, 1] == 0
+
+    # a pixel with no valid neighbour on its row nor its column is filled by the second pass
+    swath = np.full((1, 3, 3), np.nan, dtype=np.float32)
+    swath[0, 0, 0] = 2.
+
+    assert fill_all_channels(swath) == [0]
+    assert np.allclose(swath, 2.)
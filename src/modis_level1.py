@@ -4,6 +4,8 @@ import os
 
 from satpy import Scene
 
+from src.interpolation import fill_all_channels
+
 MAX_WIDTH, MAX_HEIGHT = 1354, 2030
 
 def find_matching_geoloc_file(radiance_filename, myd03_dir):
@@ -38,11 +40,12 @@ def find_all_radiance_geoloc_pairs(path):
 
     return pairs
 
-def get_swath(radiance_filename, myd03_dir):
+def get_swath(radiance_filename, myd03_dir, out=None):
     """
     :param radiance_filename: MYD02 filename
     :param myd03_dir: root directory of MYD03 geolocational files
-    :return swath: numpy.ndarray of size (15, HEIGHT, WIDTH) 
+    :param out: optional array the swath is written into, if it has the expected shape. Allows to reuse the same array across swaths
+    :return swath: numpy.ndarray of size (15, HEIGHT, WIDTH), as float32 to keep the precision of the geolocation
     Uses the satpy Scene reader with the modis-l1b files. Issues reading files might be due to pyhdf not being
     installed - otherwise try pip install satpy[modis_0l1b]
     Creates a scene with the MYD02 and MYD03 files, and extracts them as multi-channel arrays. The lat and long are
@@ -63,28 +66,34 @@ def get_swath(radiance_filename, myd03_dir):
 
     # load latitudes and longitudes, resolution 1km
     global_scene.load(['latitude', 'longitude'], resolution=1000)
-    latitude = np.array(global_scene['latitude'].load())
-    longitude = np.array(global_scene['longitude'].load())
+    latitude = np.asarray(global_scene['latitude'].load())[:MAX_HEIGHT, :MAX_WIDTH]
+    longitude = np.asarray(global_scene['longitude'].load())[:MAX_HEIGHT, :MAX_WIDTH]
+
+    shape = (len(composite) + 2, *latitude.shape)
+
+    swath = out
 
-    swath = []
+    if swath is None or swath.shape != shape:
+        swath = np.empty(shape, dtype=np.float32)
 
-    for comp in composite:
-        temp = np.array(global_scene[comp].load())
-        swath.append(temp[:MAX_HEIGHT, :MAX_WIDTH])
+    for i, comp in enumerate(composite):
+        temp = np.asarray(global_scene[comp].load())
+        np.copyto(swath[i], temp[:MAX_HEIGHT, :MAX_WIDTH], casting='unsafe')
 
-    swath.append(latitude[:MAX_HEIGHT, :MAX_WIDTH])
-    swath.append(longitude[:MAX_HEIGHT, :MAX_WIDTH])
+    np.copyto(swath[-2], latitude, casting='unsafe')
+    np.copyto(swath[-1], longitude, casting='unsafe')
 
-    return np.array(swath, dtype=np.float16)
+    return swath
 
 def get_swath_rgb(radiance_filename, myd03_dir, composite='true_color'):
     """
     :param radiance_filename: MYD02 filename
     :param myd03_dir: root directory of MYD03 geolocational files
-    :return visible RGB channels: numpy.ndarray of size (3, 2030, 1354) 
+    :return visible RGB channels: C-contiguous numpy.ndarray of size (2030, 1354, 3) and type uint8, ready for PIL
     Uses the satpy Scene reader with the modis-l1b files. Issues reading files might be due to pyhdf not being
     installed - otherwise try pip install satpy[modis_0l1b]
     Creates a scene with the MYD02 file, and extracts the RGB channels from the 1, 4, 3 visible MODIS bands.
+    Missing values are interpolated before casting, raises ValueError if a channel cannot be filled.
     """
 
     # find a corresponding geolocational (MOD03) file for the provided radiance (MYD02) file
@@ -95,6 +104,15 @@ def get_swath_rgb(radiance_filename, myd03_dir, composite='true_color'):
     # load it in, make sure resolution is 1000 to match our other datasets
     global_scene.load([composite], resolution=1000)
 
-    rgb = np.array(global_scene[composite])[:,:MAX_HEIGHT,:MAX_WIDTH]
+    rgb = np.array(global_scene[composite], dtype=np.float32)[:,:MAX_HEIGHT,:MAX_WIDTH]
+
+    # interpolate to remove NaN artefacts, they cannot be represented once cast to uint8
+    filled_ch_idx = fill_all_channels(rgb)
+
+    if len(filled_ch_idx) != rgb.shape[0]:
+        raise ValueError("channels {} could not be interpolated".format(sorted(set(range(rgb.shape[0])) - set(filled_ch_idx))))
+
+    np.clip(rgb, 0, 255, out=rgb)
 
-    return rgb
+    # cast and move the channels last in a single copy
+    return np.ascontiguousarray(np.moveaxis(rgb, 0, -1), dtype=np.uint8)
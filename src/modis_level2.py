@@ -3,7 +3,6 @@ import numpy as np
 import os
 
 from pyhdf.SD import SD, SDC
-from satpy import Scene
 
 '''take in the MODIS level 1 filename to get the information needed to find the corresponding MODIS level 2 filename.
 This info includes the YYYY and day in year (ex: AYYYYDIY) and then the time of the pass (ex1855)
@@ -11,6 +10,9 @@ It returns the full level 2 filename path'''
 
 MAX_WIDTH, MAX_HEIGHT = 1354, 2030
 
+# level 2 (MYD06) datasets extracted as channels
+L2_CHANNELS = ['Cloud_Water_Path', 'Cloud_Optical_Thickness', 'Cloud_Effective_Radius', 'Cloud_Phase_Optical_Properties', 'cloud_top_pressure_1km', 'cloud_top_height_1km', 'cloud_top_temperature_1km', 'cloud_emissivity_1km', 'surface_temperature_1km']
+
 def get_matching_l2_filename(radiance_filename, l2_dir):
     """
     :param radiance_filename: the filename for the radiance .hdf, demarcated with "MOD021KM".
@@ -28,51 +30,72 @@ def get_matching_l2_filename(radiance_filename, l2_dir):
     l2_filename = glob.glob(os.path.join(l2_dir, 'MYD06_L2.{}.{}.*.hdf'.format(tail_parts[1], tail_parts[2])))[0]
     return l2_filename
 
-def get_channels(l1_filename, l2_dir):
+def get_matching_cloud_mask_filename(radiance_filename, cloud_mask_dir):
+    """
+    :param radiance_filename: the filename for the radiance .hdf, demarcated with "MYD021KM".
+    :param cloud_mask_dir: the root directory containing the cloud mask files.
+    :return cloud_mask_filename: the path to the corresponding cloud mask file, demarcated with "MYD35"
+    """
 
-    """ take in the level 1 filename and rootdir for the level 2 data, returns an np.array of size (10, HEIGHT, WIDTH) with all l2 channels"""
+    return glob.glob(os.path.join(cloud_mask_dir, 'MYD35*' + radiance_filename.split('.A')[1][:12] + '*'))[0]
 
-    filename = get_matching_l2_filename(l1_filename, l2_dir)
+def open_l2_and_l35(l1_filename, l2_dir, cloud_mask_dir):
+    """ take in the level 1 filename and the rootdirs of the level 2 and cloud mask data, returns the open level 2 (MYD06) and cloud mask (MYD35) files. The caller is responsible for closing them with end() """
 
-    level_data = SD(filename, SDC.READ)
+    l2_filename = get_matching_l2_filename(l1_filename, l2_dir)
+    cloud_mask_filename = get_matching_cloud_mask_filename(l1_filename, cloud_mask_dir)
 
-    lwp = level_data.select('Cloud_Water_Path').get()[:MAX_HEIGHT,:MAX_WIDTH]
-    cod = level_data.select('Cloud_Optical_Thickness').get()[:MAX_HEIGHT,:MAX_WIDTH]
-    cer = level_data.select('Cloud_Effective_Radius').get()[:MAX_HEIGHT,:MAX_WIDTH]
-    cpop = level_data.select('Cloud_Phase_Optical_Properties').get()[:MAX_HEIGHT,:MAX_WIDTH]
+    level_data = SD(l2_filename, SDC.READ)
 
-    ctp = level_data.select('cloud_top_pressure_1km').get()[:MAX_HEIGHT,:MAX_WIDTH]
-    cth = level_data.select('cloud_top_height_1km').get()[:MAX_HEIGHT,:MAX_WIDTH]
-    ctt = level_data.select('cloud_top_temperature_1km').get()[:MAX_HEIGHT,:MAX_WIDTH]
-    cee = level_data.select('cloud_emissivity_1km').get()[:MAX_HEIGHT,:MAX_WIDTH]
+    try:
+        cloud_mask_data = SD(cloud_mask_filename, SDC.READ)
 
-    st = level_data.select('surface_temperature_1km').get()[:MAX_HEIGHT,:MAX_WIDTH]
-    
-    channels = np.stack([lwp, cod, cer, cpop, ctp, cth, ctt, cee, st])
+    except:
+        level_data.end()
+        raise
 
-    return channels.astype(np.float16)
+    return level_data, cloud_mask_data
 
-def get_cloud_mask(l1_filename, cloud_mask_dir):
-    
-    """ return a 2d mask, with cloudy pixels marked as 1, non-cloudy pixels marked as 0 """
-    
-    basename = os.path.split(l1_filename)
+def get_channels(level_data, out=None):
 
-    cloud_mask_filename = glob.glob(os.path.join(cloud_mask_dir, 'MYD35*' + l1_filename.split('.A')[1][:12] + '*'))[0]
-    
-    # satpy returns(0=Cloudy, 1=Uncertain, 2=Probably Clear, 3=Confident Clear)
-    swath = Scene(reader = 'modis_l2', filenames = [cloud_mask_filename])
-    swath.load(['cloud_mask'], resolution = 1000)
+    """ take in an open level 2 file, returns an np.array of size (9, HEIGHT, WIDTH) with all l2 channels. They are written into <out> if it has the same shape, otherwise into a new float16 array"""
+
+    height, width = level_data.select(L2_CHANNELS[0]).info()[2][:2]
+    shape = (len(L2_CHANNELS), min(height, MAX_HEIGHT), min(width, MAX_WIDTH))
+
+    channels = out
+
+    if channels is None or channels.shape != shape:
+        channels = np.empty(shape, dtype=np.float16)
+
+    # each channel is read and cast directly into its slice of the output
+    for i, name in enumerate(L2_CHANNELS):
+        channels[i] = level_data.select(name)[:MAX_HEIGHT, :MAX_WIDTH]
+
+    return channels
+
+def get_cloud_mask(cloud_mask_data):
     
-    cloud_mask = np.array(swath['cloud_mask'].load())[:MAX_HEIGHT, :MAX_WIDTH]
+    """ take in an open cloud mask file, return a 2d mask, with cloudy pixels marked as 1, non-cloudy pixels marked as 0 """
+
+    # bit 0 of the first byte flags determined pixels (fill pixels are 0), bits 1-2 hold the cloudiness (0=Cloudy, 1=Uncertain, 2=Probably Clear, 3=Confident Clear)
+    first_byte = cloud_mask_data.select('Cloud_Mask')[0, :MAX_HEIGHT, :MAX_WIDTH]
+
+    # bit 0 of the first quality assurance byte flags useful cloud mask values, as masked by satpy's modis_l2 reader
+    first_qa_byte = cloud_mask_data.select('Quality_Assurance')[:MAX_HEIGHT, :MAX_WIDTH, 0]
 
-    cloud_mask = (cloud_mask == 0)
-    cloud_mask = cloud_mask.astype(np.intp)
+    determined = (first_byte & 1) == 1
+    useful = (first_qa_byte & 1) == 1
+
+    cloud_mask = determined & useful & (((first_byte >> 1) & 0b11) == 0)
+    cloud_mask = cloud_mask.astype(np.uint8)
     
     return cloud_mask
 
 if __name__ == "__main__":
-    
+
+    import sys
+
     l1_path = sys.argv[1]
     cloudmask_dir = "../DATA/aqua-data/cloud_mask/"
 
@@ -81,6 +104,8 @@ if __name__ == "__main__":
     if not os.path.exists(save_dir):
         os.makedirs(save_dir)
 
-    cloudmask = get_cloud_mask(l1_path, cloudmask_dir)
+    cloud_mask_data = SD(get_matching_cloud_mask_filename(l1_path, cloudmask_dir), SDC.READ)
+    cloudmask = get_cloud_mask(cloud_mask_data)
+    cloud_mask_data.end()
 
     np.save(os.path.join(save_dir, os.path.basename(l1_path).replace(".hdf", ".npy")), cloudmask)
@@ -1,8 +1,8 @@
 import numpy as np
 import random
 
+from scipy.spatial import cKDTree
 from scipy.stats import mode
-from sklearn.metrics.pairwise import manhattan_distances
 
 MAX_WIDTH, MAX_HEIGHT = 1354, 2030
 
@@ -28,14 +28,14 @@ def find_track_range(cs_latitudes, cs_longitudes, latitudes, longitudes):
     return max(0, min_j - 100), min(max_j + 100, MAX_WIDTH - 1)
 
 def scalable_align(cs_lat, cs_lon, swath_lat, swath_lon):
-    """  """
+    """ maps each track point to its closest swath pixel in manhattan distance. A kd-tree over the swath pixels avoids computing the full (nb_pixels, nb_track_points) distance matrix """
     (n, m) = swath_lat.shape
 
     swath_points = np.stack((swath_lat.flatten(), swath_lon.flatten())).T
     track_points = np.stack((cs_lat, cs_lon), axis=1)
   
-    dist = manhattan_distances(swath_points, track_points)
-    mapping = np.unravel_index(np.argmin(dist, axis=0), (n, m))
+    _, closest = cKDTree(swath_points).query(track_points, p=1)
+    mapping = np.unravel_index(closest, (n, m))
 
     return mapping
 
@@ -100,3 +100,19 @@ if __name__ == "__main__":
     labels = map_labels(mapping, np.array(test_track[2])[:, None], (5, 3))
 
     print(labels)
+
+    # the kd-tree mapping equals the brute force argmin of manhattan distances
+    rng = np.random.RandomState(0)
+
+    grid_lat = np.cumsum(rng.rand(60, 40), axis=0)
+    grid_lon = np.cumsum(rng.rand(60, 40), axis=1)
+    track_lat = rng.rand(100) * grid_lat.max()
+    track_lon = rng.rand(100) * grid_lon.max()
+
+    mapping = scalable_align(track_lat, track_lon, grid_lat, grid_lon)
+
+    dist = np.abs(grid_lat.reshape(-1, 1) - track_lat) + np.abs(grid_lon.reshape(-1, 1) - track_lon)
+    brute_mapping = np.unravel_index(np.argmin(dist, axis=0), grid_lat.shape)
+
+    assert np.all(mapping[0] == brute_mapping[0])
+    assert np.all(mapping[1] == brute_mapping[1])